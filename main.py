@@ -1,7 +1,16 @@
-import os, re, time, random, json, html
+import os, re, sys, time, random, json, html, io, threading, socket
+from urllib.parse import urlsplit
+import cProfile, pstats, tracemalloc
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
 
+try:
+    import resource  # POSIX فقط؛ يُستخدم لذروة RSS في وضع القياس
+except ImportError:
+    resource = None
+
 import requests
 import backoff
 import feedparser
@@ -35,6 +44,11 @@ PEXELS_API_KEY = os.getenv("PEXELS_API_KEY", "")
 PIXABAY_API_KEY = os.getenv("PIXABAY_API_KEY", "")
 FORCED_IMAGE = os.getenv("FEATURED_IMAGE_URL", "").strip()
 
+# صورة البداية: نسخ بعدة عروض (srcset) وحد أقصى لعرض src الافتراضي
+IMG_WIDTHS = (500, 960, 1280)  # مقاسات قياسية لمصغّرات ويكيميديا
+IMG_SRC_MAX_W = int(os.getenv("IMG_SRC_MAX_WIDTH", "960"))
+IMG_SIZES = "(max-width: 800px) 100vw, 800px"
+
 # ترند دولة واحدة (fallback) أو قائمة دول إقليمية
 TREND_GEO = os.getenv("TREND_GEO", "IQ")
 TREND_GEO_LIST = [
@@ -53,6 +67,17 @@ RUN_ONCE = os.getenv("RUN_ONCE", "0") == "1"
 USE_EXTERNAL_CRON = os.getenv("USE_EXTERNAL_CRON", "0") == "1"
 TRIGGER_TOKEN = os.getenv("TRIGGER_TOKEN", "")  # ضع كلمة سر قوية
 
+# وضع القياس: cProfile + tracemalloc لكل تشغيل مع تقرير في PROFILE_DIR
+PROFILE_MODE = os.getenv("PROFILE_MODE", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+
+# توليد على مرحلتين: عنوان + مخطط H2 بموديل صغير يُفحص ضد السجل قبل المقالة الكاملة
+OUTLINE_PRECHECK = os.getenv("OUTLINE_PRECHECK", "1") == "1"
+OUTLINE_MODEL = os.getenv("OUTLINE_MODEL", "models/gemini-1.5-flash-8b")
+OUTLINE_MAX_TOKENS = 256
+OUTLINE_TRIES = 2  # محاولات العنوان لكل موضوع قبل الانتقال لموضوع آخر
+
 # REST v1 (Gemini) – بلا gRPC
 GEMINI_API_ROOT = "https://generativelanguage.googleapis.com/v1"
 MODEL_CANDIDATES = [
@@ -63,23 +88,46 @@ MODEL_CANDIDATES = [
 GEN_CONFIG = {"temperature": 0.7, "topP": 0.9, "maxOutputTokens": 4096}
 _cached_model = None
 
+# ميزانية التوكنات: نطلب من Gemini فقط ما يحتاجه مدى الكلمات المطلوب
+AR_TOKENS_PER_WORD = float(os.getenv("AR_TOKENS_PER_WORD",
+                                     "2.2"))  # تقدير أولي قبل التعلّم
+OUTPUT_TOKEN_HEADROOM = float(os.getenv("OUTPUT_TOKEN_HEADROOM", "1.15"))
+MAX_OUTPUT_TOKENS_CAP = int(os.getenv("MAX_OUTPUT_TOKENS_CAP", "8192"))
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "2"))
+TOKEN_USAGE_FILE = "token_usage.jsonl"  # سجل استهلاك التوكنات لكل طلب
+TOKEN_RATIO_WINDOW = 50  # آخر 50 طلباً لتقدير نسبة توكن/كلمة
+_tokens_per_word = None
+_token_totals = {"models": {}, "categories": {}}
+
 # منع التكرار (سجلات محلية بسيطة)
 HISTORY_TITLES_FILE = "posted_titles.jsonl"  # سجل العناوين
 HISTORY_TOPICS_FILE = "used_topics.jsonl"  # سجل المفاتيح الموضوعية
 TITLE_WINDOW = 30  # لا نكرّر آخر 30 عنواناً
+OUTBOX_DIR = "publish_outbox"  # ملف لكل تشغيل غير مكتمل (يُحذف عند الاكتمال)
+OUTBOX_CLAIM_STALE_MIN = int(os.getenv("OUTBOX_CLAIM_STALE_MIN", "60"))
+
+# فحص روابط المراجع (مع كاش دائم للنتائج)
+LINK_CACHE_FILE = "link_status.jsonl"  # url -> verdict
+LINK_CACHE_TTL_H = int(os.getenv("LINK_CACHE_TTL_HOURS", "72"))
+LINK_CHECK_WORKERS = int(os.getenv("LINK_CHECK_WORKERS", "8"))
+LINK_CHECK_TIMEOUT = float(os.getenv("LINK_CHECK_TIMEOUT", "5"))
+LINK_DNS_CONTROL_HOST = os.getenv("LINK_DNS_CONTROL_HOST", "www.google.com")
 
 # Flask app (لو استخدمنا الكرون الخارجي)
 app = Flask(__name__)
 
 
 # =================== أدوات نص/HTML ===================
+def trim_to_sentence_end(text):
+    m = re.search(r"(.+[.!؟…])", text, flags=re.S)
+    return m.group(1) if m else text
+
+
 def clamp_words_ar(text, min_words=1000, max_words=1400):
     words = text.split()
     if len(words) < min_words: return text
     if len(words) <= max_words: return text
-    clipped = " ".join(words[:max_words])
-    m = re.search(r"(.+[.!؟…])", clipped, flags=re.S)
-    return m.group(1) if m else clipped
+    return trim_to_sentence_end(" ".join(words[:max_words]))
 
 
 def strip_code_fences(text):
@@ -125,8 +173,181 @@ def linkify_urls_md(text: str) -> str:
         url = m.group(0)
         return f"[المصدر]({url})"
 
-    # لا يمس الروابط التي هي أصلاً [نص](رابط)
-    return re.sub(r'(?<!\()https?://[^\s)]+', _repl, text)
+    # لا يمس الروابط التي هي أصلاً [نص](رابط) ولا نصها مثل [https://x](https://x)
+    return sub_outside_md_links(_BARE_URL_RE, _repl, text)
+
+
+BASE_REFS = {
+    "tech": [
+        ("MIT Technology Review", "https://www.technologyreview.com/"),
+        ("ACM Digital Library", "https://dl.acm.org/"),
+        ("IEEE Spectrum", "https://spectrum.ieee.org/"),
+        ("World Economic Forum — Tech",
+         "https://www.weforum.org/focus/technology/"),
+    ],
+    "science": [
+        ("Nature", "https://www.nature.com/"),
+        ("Science", "https://www.science.org/"),
+        ("UNESCO Science Report", "https://www.unesco.org/reports/science/"),
+        ("Royal Society", "https://royalsociety.org/"),
+    ],
+    "economy": [
+        ("World Bank — Data", "https://data.worldbank.org/"),
+        ("OECD Library", "https://www.oecd-ilibrary.org/"),
+        ("IMF Publications", "https://www.imf.org/en/Publications"),
+        ("UNDP Reports", "https://www.undp.org/publications"),
+    ],
+    "news": [
+        ("Google News", "https://news.google.com/"),
+        ("BBC Middle East", "https://www.bbc.com/arabic/topics/c2dwq6y7v3yt"),
+        ("Al Jazeera — Middle East", "https://www.aljazeera.net/news/politics"),
+        ("Reuters — Middle East", "https://www.reuters.com/world/middle-east/"),
+    ],
+}
+
+
+# =================== فحص روابط المراجع ===================
+_MD_LINK_RE = r"\[([^\]]+)\]\((https?://[^)\s]+)\)"
+_BARE_URL_RE = r"(?<!\()https?://[^\s)\]]+"
+_ANY_MD_LINK_RE = r"(\[[^\]]*\]\([^)]*\))"
+
+
+def sub_outside_md_links(pattern, repl, text):
+    """re.sub على النص خارج صيغة [نص](رابط) فقط (مثل [https://x](https://x))."""
+    parts = re.split(_ANY_MD_LINK_RE, text)
+    return "".join(p if i % 2 else re.sub(pattern, repl, p)
+                   for i, p in enumerate(parts))
+
+
+def link_urls(text):
+    """كل الروابط في النص: روابط الماركداون ثم العارية خارجها."""
+    urls = [u for _, u in re.findall(_MD_LINK_RE, text)]
+    for i, p in enumerate(re.split(_ANY_MD_LINK_RE, text)):
+        if not i % 2:
+            urls += re.findall(_BARE_URL_RE, p)
+    return urls
+
+
+def load_link_cache():
+    cutoff = datetime.now(TZ) - timedelta(hours=LINK_CACHE_TTL_H)
+    cache = {}
+    for r in load_jsonl(LINK_CACHE_FILE):  # آخر نتيجة لكل رابط هي المعتمدة
+        try:
+            if datetime.fromisoformat(r.get("time")) >= cutoff:
+                cache[r["url"]] = r
+        except:
+            pass
+    return cache
+
+
+def _nxdomain(host):
+    try:
+        socket.getaddrinfo(host, None)
+        return False
+    except socket.gaierror as e:
+        nxdomain = {socket.EAI_NONAME, getattr(socket, "EAI_NODATA", None)}
+        return e.errno in nxdomain
+    except OSError:
+        return False
+
+
+def host_unresolvable(url):
+    """
+    True فقط إذا أكّد DNS أن النطاق غير موجود (وليس انقطاع شبكتنا):
+    المحلِّل المعطّل يرد EAI_NONAME لكل نطاق، لذا نشترط أن يُحلّ نطاق مرجعي.
+    """
+    host = urlsplit(url).hostname
+    if not host: return True
+    if not _nxdomain(host): return False
+    try:
+        socket.getaddrinfo(LINK_DNS_CONTROL_HOST, None)
+    except OSError:
+        return False  # لا يمكن الحكم: DNS لدينا لا يعمل
+    return True
+
+
+def check_link(url):
+    """يرجع ok | broken | unknown (unknown: لا نحكم على الرابط ولا نحفظه)."""
+    headers = {"User-Agent": "Mozilla/5.0 (compatible; blogger-auto-poster)"}
+    try:
+        r = requests.head(url,
+                          allow_redirects=True,
+                          timeout=LINK_CHECK_TIMEOUT,
+                          headers=headers)
+        if r.status_code in (404, 405, 410, 501) or r.status_code >= 500:
+            # بعض الخوادم لا تدعم HEAD أو ترد عليه بـ 404: نؤكد بـ GET دون تنزيل الجسم
+            with requests.get(url,
+                              allow_redirects=True,
+                              timeout=LINK_CHECK_TIMEOUT,
+                              headers=headers,
+                              stream=True) as g:
+                r = g
+        code = r.status_code
+        if code < 400: return "ok", code
+        if code in (404, 410): return "broken", code
+        return "unknown", code  # 401/403/429… غالباً حماية ضد البوتات
+    except requests.exceptions.ConnectionError:
+        # إعادة ضبط الاتصال/SSL/انقطاع شبكتنا ليست دليلاً؛ فقط النطاق المعدوم
+        if host_unresolvable(url): return "broken", None
+        return "unknown", None
+    except requests.RequestException:
+        return "unknown", None  # مهلة، تحويلات كثيرة، جسم مقطوع…
+
+
+def validate_links(urls):
+    """يفحص الروابط بالتوازي مع كاش دائم؛ يرجع {url: verdict}."""
+    cache = load_link_cache()
+    verdicts = {u: cache[u]["verdict"] for u in urls if u in cache}
+    pending = [u for u in dict.fromkeys(urls) if u not in verdicts]
+    if pending:
+        with ThreadPoolExecutor(
+                max_workers=min(LINK_CHECK_WORKERS, len(pending))) as ex:
+            for url, (verdict, code) in zip(pending,
+                                            ex.map(check_link, pending)):
+                verdicts[url] = verdict
+                if verdict != "unknown":
+                    append_jsonl(
+                        LINK_CACHE_FILE, {
+                            "url": url,
+                            "verdict": verdict,
+                            "status": code,
+                            "time": datetime.now(TZ).isoformat()
+                        })
+                print(f"[LINK] {verdict} {code}: {url}")
+    return verdicts
+
+
+def replace_broken_links(text, trusted=()):
+    """
+    يزيل الروابط المعطوبة: في المتن يبقى نص الرابط بلا رابط،
+    وفي قسم "المراجع" يُحذف البند كله (ثم يُكمَّل القسم من BASE_REFS).
+    """
+    urls = link_urls(text)
+    verdicts = validate_links([u for u in urls if u not in set(trusted)])
+    broken = {u for u, v in verdicts.items() if v == "broken"}
+    if not broken:
+        return text
+
+    def _strip(t):
+        t = sub_outside_md_links(
+            _BARE_URL_RE, lambda m: ""
+            if m.group(0) in broken else m.group(0), t)
+        return re.sub(_MD_LINK_RE, _unlink, t)
+
+    def _unlink(m):
+        if m.group(2) not in broken: return m.group(0)
+        # نص الرابط نفسه رابط معطوب ([https://x](https://x)): نحذفه كله
+        return "" if re.match(r"https?://", m.group(1)) else m.group(1)
+
+    idx = text.rfind("المراجع")
+    body, refs = (text[:idx], text[idx:]) if idx >= 0 else (text, "")
+    kept = []
+    for line in refs.splitlines():
+        line_urls = link_urls(line)
+        if line_urls and all(u in broken for u in line_urls):
+            continue  # مرجع مخترع: نحذف البند
+        kept.append(_strip(line))
+    return _strip(body) + "\n".join(kept)
 
 
 def ensure_references_clickable(article_md, category, topic, news_link=None):
@@ -135,44 +356,18 @@ def ensure_references_clickable(article_md, category, topic, news_link=None):
     if "المراجع" not in text:
         text += "\n\n## المراجع\n"
 
-    links = re.findall(r"\[[^\]]+\]\((https?://[^)]+)\)", text)
-    needed = max(0, 4 - len(links))
-
-    base_refs = {
-        "tech": [
-            ("MIT Technology Review", "https://www.technologyreview.com/"),
-            ("ACM Digital Library", "https://dl.acm.org/"),
-            ("IEEE Spectrum", "https://spectrum.ieee.org/"),
-            ("World Economic Forum — Tech",
-             "https://www.weforum.org/focus/technology/"),
-        ],
-        "science": [
-            ("Nature", "https://www.nature.com/"),
-            ("Science", "https://www.science.org/"),
-            ("UNESCO Science Report",
-             "https://www.unesco.org/reports/science/"),
-            ("Royal Society", "https://royalsociety.org/"),
-        ],
-        "economy": [
-            ("World Bank — Data", "https://data.worldbank.org/"),
-            ("OECD Library", "https://www.oecd-ilibrary.org/"),
-            ("IMF Publications", "https://www.imf.org/en/Publications"),
-            ("UNDP Reports", "https://www.undp.org/publications"),
-        ],
-        "news": [
-            ("Google News", "https://news.google.com/"),
-            ("BBC Middle East",
-             "https://www.bbc.com/arabic/topics/c2dwq6y7v3yt"),
-            ("Al Jazeera — Middle East",
-             "https://www.aljazeera.net/news/politics"),
-            ("Reuters — Middle East",
-             "https://www.reuters.com/world/middle-east/"),
-        ],
-    }
     extra = []
     if category == "news" and news_link:
         extra.append(("مصدر الخبر", news_link))
-    extra += base_refs.get(category, base_refs["science"])
+    extra += BASE_REFS.get(category, BASE_REFS["science"])
+
+    # الروابط التي لا تعمل (مخترعة غالباً) تُزال، ويُكمَّل القسم أدناه
+    trusted = [u for _, u in extra]
+    text = replace_broken_links(text, trusted=trusted)
+
+    links = re.findall(r"\[[^\]]+\]\((https?://[^)]+)\)", text)
+    needed = max(0, 4 - len(links))
+    extra = [(n, u) for n, u in extra if u not in links]
 
     if needed > 0:
         text += "\n"
@@ -249,6 +444,84 @@ def record_publish(title, topic_key):
     })
 
 
+# =================== Outbox: نقاط حفظ مراحل النشر ===================
+class SlotBusyError(RuntimeError):
+    """تشغيل آخر لهذه الفتحة قيد التنفيذ حالياً."""
+
+
+def _outbox_path(name):
+    return os.path.join(OUTBOX_DIR, name)
+
+
+def claim_slot(slot_idx):
+    """
+    حجز حصري للفتحة عبر ملف يُنشأ بـ O_EXCL (يعمل عبر الخيوط والعمليات)،
+    كي لا يصل طلبان متزامنان للفتحة نفسها إلى post_to_blogger.
+    """
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    path = _outbox_path(f"slot-{slot_idx}.lock")
+    try:
+        if time.time() - os.path.getmtime(path) > OUTBOX_CLAIM_STALE_MIN * 60:
+            os.remove(path)  # حجز يتيم من عملية ماتت
+    except OSError:
+        pass
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        raise SlotBusyError(f"slot {slot_idx} is already running")
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{os.getpid()} {datetime.now(TZ).isoformat()}")
+    return path
+
+
+def release_slot(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def open_outbox_run(slot_idx, day=None):
+    """
+    يستأنف آخر تشغيل غير مكتمل لهذه الفتحة اليوم، أو يبدأ تشغيلاً جديداً.
+    تشغيلات الأيام السابقة لا تُستأنف فتُحذف.
+    """
+    day = day or date.today()
+    prefix = f"{day.isoformat()}-{slot_idx}-"
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    pending = []
+    for name in os.listdir(OUTBOX_DIR):
+        if not name.endswith(".jsonl"): continue
+        if name.startswith(prefix):
+            pending.append(name[:-len(".jsonl")])
+        elif name[:10] < day.isoformat():
+            os.remove(_outbox_path(name))
+    if pending:
+        run_id = max(pending, key=lambda r: int(r.rsplit("-", 1)[1]))
+        stages = {
+            r.get("stage"): r.get("data", {})
+            for r in load_jsonl(_outbox_path(f"{run_id}.jsonl"))
+        }
+        return run_id, stages
+    return f"{prefix}{int(time.time())}", {}
+
+
+def checkpoint(run_id, stage, data):
+    append_jsonl(_outbox_path(f"{run_id}.jsonl"), {
+        "stage": stage,
+        "data": data,
+        "time": datetime.now(TZ).isoformat()
+    })
+    return data
+
+
+def finish_outbox_run(run_id):
+    try:
+        os.remove(_outbox_path(f"{run_id}.jsonl"))
+    except OSError:
+        pass
+
+
 # =================== موديلات Gemini (REST) ===================
 def list_models():
     url = f"{GEMINI_API_ROOT}/models?key={GEMINI_API_KEY}"
@@ -279,48 +552,234 @@ def gen_url_for(model_name):
     return f"{GEMINI_API_ROOT}/{model_name}:generateContent?key={GEMINI_API_KEY}"
 
 
-def _call_gemini_with_model(model_name, prompt):
-    payload = {
-        "contents": [{
-            "role": "user",
-            "parts": [{
-                "text": prompt
-            }]
-        }],
-        "generationConfig": GEN_CONFIG
-    }
+def _call_gemini_with_model(model_name,
+                            prompt,
+                            max_output_tokens=None,
+                            history=None):
+    contents = list(history or []) + [{
+        "role": "user",
+        "parts": [{
+            "text": prompt
+        }]
+    }]
+    gen_config = dict(GEN_CONFIG)
+    if max_output_tokens:
+        gen_config["maxOutputTokens"] = int(max_output_tokens)
+    payload = {"contents": contents, "generationConfig": gen_config}
     return requests.post(gen_url_for(model_name), json=payload, timeout=120)
 
 
+# =================== محاسبة التوكنات وميزانية الطول ===================
+def tokens_per_word():
+    """نسبة توكنات الإخراج لكل كلمة عربية، متعلَّمة من السجل."""
+    global _tokens_per_word
+    if _tokens_per_word is None:
+        rows = [
+            r for r in load_jsonl(TOKEN_USAGE_FILE)
+            if r.get("words") and r.get("candidate_tokens")
+            and r.get("kind") != "outline"
+        ][-TOKEN_RATIO_WINDOW:]
+        words = sum(r["words"] for r in rows)
+        tokens = sum(r["candidate_tokens"] for r in rows)
+        _tokens_per_word = (tokens / words) if words else AR_TOKENS_PER_WORD
+    return _tokens_per_word
+
+
+def learn_tokens_per_word(candidate_tokens, words):
+    global _tokens_per_word
+    if words < 50 or not candidate_tokens:  # العينات القصيرة جداً مضلِّلة
+        return
+    sample = candidate_tokens / words
+    _tokens_per_word = 0.7 * tokens_per_word() + 0.3 * sample
+
+
+def output_budget(words):
+    """maxOutputTokens المناسب لعدد كلمات مستهدف."""
+    budget = int(words * tokens_per_word() * OUTPUT_TOKEN_HEADROOM) + 1
+    return max(256, min(MAX_OUTPUT_TOKENS_CAP, budget))
+
+
+def record_token_usage(model, category, usage, words, kind):
+    prompt_tokens = int(usage.get("promptTokenCount", 0) or 0)
+    candidate_tokens = int(usage.get("candidatesTokenCount", 0) or 0)
+    for bucket, key in (("models", model), ("categories", category
+                                            or "other")):
+        t = _token_totals[bucket].setdefault(key, {
+            "calls": 0,
+            "prompt": 0,
+            "candidates": 0
+        })
+        t["calls"] += 1
+        t["prompt"] += prompt_tokens
+        t["candidates"] += candidate_tokens
+    append_jsonl(
+        TOKEN_USAGE_FILE, {
+            "time": datetime.now(TZ).isoformat(),
+            "model": model,
+            "category": category or "other",
+            "kind": kind,
+            "prompt_tokens": prompt_tokens,
+            "candidate_tokens": candidate_tokens,
+            "words": words
+        })
+    if kind != "outline":  # القوائم القصيرة لا تمثّل نص المقالة
+        learn_tokens_per_word(candidate_tokens, words)
+
+
+def token_usage_report():
+    """ملخص الاستهلاك التراكمي منذ بدء العملية."""
+    lines = []
+    for bucket, label in (("models", "model"), ("categories", "category")):
+        for key, t in sorted(_token_totals[bucket].items()):
+            lines.append(
+                f"  {label} {key}: calls={t['calls']} prompt={t['prompt']} candidates={t['candidates']}"
+            )
+    total_p = sum(t["prompt"] for t in _token_totals["models"].values())
+    total_c = sum(t["candidates"] for t in _token_totals["models"].values())
+    lines.append(
+        f"  total: prompt={total_p} candidates={total_c} sum={total_p + total_c} | tokens/word={tokens_per_word():.2f}"
+    )
+    return "[TOKENS]\n" + "\n".join(lines)
+
+
 @backoff.on_exception(backoff.expo,
                       Exception,
                       base=AI_BACKOFF_BASE,
                       max_tries=AI_MAX_RETRIES)
-def ask_gemini(prompt: str) -> str:
+def _generate(prompt,
+              category=None,
+              max_output_tokens=None,
+              history=None,
+              prefer=None,
+              kind="initial"):
+    """طلب واحد إلى Gemini مع تبديل الموديل عند 403/404؛ يرجع (النص، الموديل، سبب التوقف)."""
     try:
-        first = pick_supported_model()
+        first = prefer or pick_supported_model()
     except Exception:
         first = MODEL_CANDIDATES[0]
     tried = []
     for cand in [first] + [m for m in MODEL_CANDIDATES if m != first]:
         if cand in tried: continue
         tried.append(cand)
-        r = _call_gemini_with_model(cand, prompt)
+        r = _call_gemini_with_model(cand,
+                                    prompt,
+                                    max_output_tokens=max_output_tokens,
+                                    history=history)
         if r.status_code == 200:
             data = r.json()
             try:
-                text = data["candidates"][0]["content"]["parts"][0]["text"]
+                c = data["candidates"][0]
+                text = c["content"]["parts"][0]["text"]
             except Exception:
                 raise RuntimeError(f"Gemini response parsing error: {data}")
-            text = strip_code_fences(text.strip())
-            return clamp_words_ar(text, 1000, 1400)
+            record_token_usage(cand, category,
+                               data.get("usageMetadata", {}) or {},
+                               len(text.split()), kind)
+            return text, cand, c.get("finishReason", "")
         if r.status_code in (403, 404):  # جرب موديل آخر
             continue
         raise RuntimeError(f"Gemini API error {r.status_code}: {r.text[:400]}")
     raise RuntimeError("تعذر استخدام أي موديل من Gemini للحساب الحالي.")
 
 
+def build_continue_prompt(words_so_far, min_words, max_words):
+    return f"""تابع كتابة المقالة نفسها من حيث توقفت تماماً.
+- لا تكرر أي جزء سابق ولا تكتب مقدمة أو عنواناً رئيسياً جديداً.
+- النص الحالي نحو {words_so_far} كلمة؛ أضف ما يجعل المجموع بين {min_words} و{max_words} كلمة.
+- إن لم يُكتب قسم "المراجع" بعد فاختم به.
+أنتِج التكملة مباشرة دون أي تعليقات جانبية.
+""".strip()
+
+
+def ask_gemini(prompt: str,
+               category=None,
+               min_words=1000,
+               max_words=1400) -> str:
+    text, model, finish = _generate(prompt,
+                                    category=category,
+                                    max_output_tokens=output_budget(max_words))
+    text = strip_code_fences(text.strip())
+    history = [{
+        "role": "user",
+        "parts": [{
+            "text": prompt
+        }]
+    }, {
+        "role": "model",
+        "parts": [{
+            "text": text
+        }]
+    }]
+    # نص قصير: نكمله بدل إعادة التوليد من الصفر
+    for _ in range(MAX_CONTINUATIONS):
+        n = len(text.split())
+        if n >= min_words: break
+        print(f"[GEMINI] short output ({n} words) — continuing")
+        follow = build_continue_prompt(n, min_words, max_words)
+        try:
+            more, model, more_finish = _generate(
+                follow,
+                category=category,
+                max_output_tokens=output_budget(max_words - n),
+                history=history,
+                prefer=model,
+                kind="continue")
+        except Exception as e:
+            # لا نخسر النص المدفوع ثمنه: نرجع ما جُمع حتى الآن
+            print(f"[GEMINI] continuation failed, keeping {n} words: {e}")
+            break
+        more = strip_code_fences(more.strip())
+        if not more: break
+        # إن قُطع النص عند حد التوكنات نكمل الجملة نفسها
+        text += (" " if finish == "MAX_TOKENS" else "\n\n") + more
+        finish = more_finish
+        history += [{
+            "role": "user",
+            "parts": [{
+                "text": follow
+            }]
+        }, {
+            "role": "model",
+            "parts": [{
+                "text": more
+            }]
+        }]
+    if finish == "MAX_TOKENS":
+        # قُطع النص عند حد التوكنات: لا ننشر جملة مبتورة مهما كان الطول
+        text = trim_to_sentence_end(text)
+    return clamp_words_ar(text, min_words, max_words)
+
+
 # =================== الصور: ويكيبيديا/ويكيميديا → Pexels/Pixabay → Placeholder ===================
+def scaled_renditions(make_url, width, height, widths=IMG_WIDTHS):
+    """[{url, width, height}] لكل عرض في widths لا يتجاوز عرض الأصل."""
+    out = []
+    for w in widths:
+        if w > width: break
+        out.append({
+            "url": make_url(w),
+            "width": w,
+            "height": round(height * w / width)
+        })
+    return out
+
+
+def with_renditions(img, renditions):
+    """يضيف النسخ للصورة ويجعل src الافتراضي أكبر نسخة ضمن IMG_SRC_MAX_W."""
+    renditions = sorted(renditions, key=lambda r: r["width"])
+    if not renditions:
+        return img
+    fitting = [r for r in renditions if r["width"] <= IMG_SRC_MAX_W]
+    default = fitting[-1] if fitting else renditions[0]
+    img.update({
+        "url": default["url"],
+        "width": default["width"],
+        "height": default["height"],
+        "renditions": renditions
+    })
+    return img
+
+
 def wiki_lead_image(title, lang="ar"):
     s = requests.get(f"https://{lang}.wikipedia.org/w/api.php",
                      params={
@@ -328,25 +787,38 @@ def wiki_lead_image(title, lang="ar"):
                          "format": "json",
                          "prop": "pageimages",
                          "piprop": "original|thumbnail",
-                         "pithumbsize": "1200",
+                         "pithumbsize": str(max(IMG_WIDTHS)),
                          "titles": title
                      },
                      timeout=20)
     if s.status_code != 200: return None
     pages = s.json().get("query", {}).get("pages", {})
     for _, p in pages.items():
-        if "original" in p: return p["original"]["source"]
-        if "thumbnail" in p: return p["thumbnail"]["source"]
+        orig, thumb = p.get("original"), p.get("thumbnail")
+        if not (orig or thumb): continue
+        base = orig or thumb
+        img = {
+            "url": base["source"],
+            "width": base.get("width"),
+            "height": base.get("height")
+        }
+        # مصغّرات ويكيميديا: .../thumb/x/xy/File.jpg/1280px-File.jpg
+        if thumb and re.search(r"/\d+px-", thumb["source"]) and img["width"]:
+            make = lambda w: re.sub(r"/\d+px-", f"/{w}px-", thumb["source"])
+            renditions = scaled_renditions(make, img["width"], img["height"])
+            return with_renditions(img, renditions)
+        return img
     return None
 
 
 def fetch_image_general(topic):
     for lang in ("ar", "en"):
         try:
-            url = wiki_lead_image(topic, lang=lang)
-            if url:
-                print(f"[IMG] wiki({lang}): {url}")
-                return {"url": url, "credit": f'Image via Wikipedia ({lang})'}
+            img = wiki_lead_image(topic, lang=lang)
+            if img:
+                print(f"[IMG] wiki({lang}): {img['url']}")
+                img["credit"] = f'Image via Wikipedia ({lang})'
+                return img
         except Exception as e:
             print(f"[IMG] wiki error {lang}: {e}")
     return None
@@ -416,14 +888,19 @@ def fetch_image(query):
             photos = r.json().get("photos", [])
             if photos:
                 p = random.choice(photos)
-                url = p["src"]["large2x"]
-                print(f"[IMG] pexels: {url}")
-                return {
+                img = {
                     "url":
-                    url,
+                    p["src"]["large2x"],
                     "credit":
                     f'صورة من Pexels — <a href="{html.escape(p["url"])}" target="_blank" rel="noopener">المصدر</a>'
                 }
+                if p.get("width") and p.get("height"):
+                    orig = p["src"]["original"]
+                    make = lambda w: f"{orig}?auto=compress&cs=tinysrgb&w={w}"
+                    img = with_renditions(
+                        img, scaled_renditions(make, p["width"], p["height"]))
+                print(f"[IMG] pexels: {img['url']}")
+                return img
         except Exception as e:
             print(f"[IMG] pexels error: {e}")
 
@@ -443,30 +920,54 @@ def fetch_image(query):
             hits = r.json().get("hits", [])
             if hits:
                 p = random.choice(hits)
-                url = p["largeImageURL"]
-                print(f"[IMG] pixabay: {url}")
-                return {
+                img = {
                     "url":
-                    url,
+                    p["largeImageURL"],
                     "credit":
                     f'صورة من Pixabay — <a href="{html.escape(p["pageURL"])}" target="_blank" rel="noopener">المصدر</a>'
                 }
+                w, h = p.get("imageWidth"), p.get("imageHeight")
+                if w and h:
+                    # روابط webformatURL صالحة 24 ساعة فقط فلا تصلح لـ HTML دائم؛
+                    # largeImageURL دائم وحده الأقصى 1280 على الضلع الأطول
+                    k = min(1.0, 1280 / max(w, h))
+                    renditions = [{
+                        "url": p["largeImageURL"],
+                        "width": round(w * k),
+                        "height": round(h * k)
+                    }]
+                    img = with_renditions(img, renditions)
+                print(f"[IMG] pixabay: {img['url']}")
+                return img
         except Exception as e:
             print(f"[IMG] pixabay error: {e}")
 
     # 4) Placeholder مضمون
     placeholder = "https://via.placeholder.com/1200x630.png?text=Research"
     print(f"[IMG] placeholder: {placeholder}")
-    return {"url": placeholder, "credit": "Placeholder"}
+    return {
+        "url": placeholder,
+        "credit": "Placeholder",
+        "width": 1200,
+        "height": 630
+    }
 
 
 def build_post_html(title, img, article_md):
-    # صورة البداية بصيغة بسيطة مضمونة مع تعليق مصدر
+    # صورة البداية: أبعاد صريحة (بلا إزاحة تخطيط) و srcset للشاشات الصغيرة
+    extra_attrs = ""
+    if img.get("width") and img.get("height"):
+        extra_attrs += f' width="{int(img["width"])}" height="{int(img["height"])}"'
+    renditions = img.get("renditions") or []
+    if len(renditions) > 1:
+        srcset = ", ".join(f'{html.escape(r["url"])} {int(r["width"])}w'
+                           for r in renditions)
+        extra_attrs += f'\n       srcset="{srcset}"\n       sizes="{IMG_SIZES}"'
     img_html = f'''
 <p style="margin:0 0 12px 0;">
-  <img src="{html.escape(img["url"])}"
+  <img src="{html.escape(img["url"])}"{extra_attrs}
        alt="{html.escape(title)}"
-       loading="lazy" decoding="async"
+       loading="eager" fetchpriority="high" decoding="async"
        style="max-width:100%;height:auto;border-radius:8px;display:block;margin:auto;" />
 </p>
 <p style="font-size:0.9em;color:#555;margin:4px 0 16px 0;">{img["credit"]}</p>
@@ -478,12 +979,57 @@ def build_post_html(title, img, article_md):
 
 
 # =================== Google Trends + Google News ===================
+def _local_tag(tag):
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def iter_rss_items(url, max_items):
+    """
+    قارئ RSS تدريجي: يقرأ الاستجابة كتدفّق ويستخرج العنوان والرابط فقط،
+    ويتوقف ويغلق الاتصال بمجرد الوصول إلى max_items.
+    يرجع None إذا كانت الخلاصة تالفة (ليستخدم المستدعي feedparser).
+    """
+    items = []
+    try:
+        with requests.get(url, stream=True, timeout=20) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True  # فك gzip أثناء القراءة
+            in_item, title, link = False, None, None
+            for event, el in ET.iterparse(r.raw, events=("start", "end")):
+                tag = _local_tag(el.tag)
+                if tag in ("item", "entry"):
+                    if event == "start":
+                        in_item, title, link = True, None, None
+                        continue
+                    in_item = False
+                    if title:
+                        items.append((title, link or ""))
+                    el.clear()  # لا نحتفظ بشجرة العناصر المقروءة
+                    if len(items) >= max_items:
+                        break
+                elif event == "end" and in_item:
+                    if tag == "title" and title is None:
+                        title = (el.text or "").strip()
+                    elif tag == "link" and link is None:
+                        link = (el.text or el.get("href") or "").strip()
+    except Exception as e:  # ParseError أو أخطاء urllib3 أثناء قراءة r.raw
+        print(f"[RSS] stream read failed, falling back to feedparser: {e}")
+        return None
+    return items
+
+
+def fetch_rss_entries(url, max_items):
+    items = iter_rss_items(url, max_items)
+    if items is not None:
+        return items
+    feed = feedparser.parse(url)
+    return [(e.title, e.get("link", "")) for e in feed.entries[:max_items]]
+
+
 def fetch_trends_list(geo: str, max_items=10):
     url = f"https://trends.google.com/trends/trendingsearches/daily/rss?geo={geo}"
-    feed = feedparser.parse(url)
     titles = []
-    for e in feed.entries[:max_items]:
-        t = e.title
+    for t, _ in fetch_rss_entries(url, max_items):
         link = f"https://www.google.com/search?q={requests.utils.quote(t)}"
         titles.append((t, link))
     return titles
@@ -507,11 +1053,9 @@ def fetch_trends_region(geos, per_geo=10):
 
 def fetch_top_me_news(n=0):
     url = "https://news.google.com/rss?hl=ar&gl=IQ&ceid=IQ:ar"
-    feed = feedparser.parse(url)
-    if feed.entries:
-        idx = min(n, len(feed.entries) - 1)
-        e = feed.entries[idx]
-        return e.title, e.link
+    entries = fetch_rss_entries(url, n + 1)
+    if entries:
+        return entries[min(n, len(entries) - 1)]
     return None, None
 
 
@@ -530,6 +1074,22 @@ def get_blog_id(service, blog_url):
     return service.blogs().getByUrl(url=blog_url).execute()["id"]
 
 
+def find_post_by_title(title):
+    """يبحث عن تدوينة (مسودة أو منشورة) بالعنوان نفسه؛ يرجعها أو None."""
+    service = get_blogger_service()
+    blog_id = get_blog_id(service, BLOG_URL)
+    res = service.posts().list(blogId=blog_id,
+                               fetchBodies=False,
+                               maxResults=20,
+                               orderBy="UPDATED",
+                               status=["DRAFT", "LIVE", "SCHEDULED"],
+                               view="ADMIN").execute()
+    for it in res.get("items", []) or []:
+        if it.get("title", "").strip() == title.strip():
+            return it
+    return None
+
+
 def post_to_blogger(title, html_content, labels=None):
     service = get_blogger_service()
     blog_id = get_blog_id(service, BLOG_URL)
@@ -613,7 +1173,11 @@ def labels_for_category(category):
 
 
 # =================== البرومبت ===================
-def build_prompt_ar(topic, kind="general", news_link=None):
+def build_prompt_ar(topic,
+                    kind="general",
+                    news_link=None,
+                    title=None,
+                    outline=None):
     base_rules = """
 - اللغة: عربية فصيحة واضحة.
 - الطول: بين 1000 و1400 كلمة.
@@ -631,14 +1195,117 @@ def build_prompt_ar(topic, kind="general", news_link=None):
 - اربط التحليل بسياق الشرق الأوسط حين يكون مناسباً.
 - أدرج رابط المصدر ضمن "المراجع": {news_link}
 """.strip()
+    plan = ""
+    if title:
+        plan = f'- ابدأ بالعنوان الرئيسي كما هو في سطر "# {title}".'
+        if outline:
+            plan += "\n- التزم بالعناوين الفرعية (H2) التالية بهذا الترتيب:\n"
+            plan += "\n".join(f"  - {h}" for h in outline)
     return f"""أنت باحث يكتب مقالة عربية رصينة ومفهومة للقارئ العام.
 الموضوع: "{topic}"
 {base_rules}
 {extra}
+{plan}
 أنتِج النص النهائي مباشرة دون أي تعليقات جانبية.
 """.strip()
 
 
+def build_outline_prompt_ar(topic, kind="general", avoid_titles=()):
+    avoid = ""
+    if avoid_titles:
+        avoid = "- تجنّب هذه العناوين وما يشبهها:\n" + "\n".join(
+            f"  - {t}" for t in avoid_titles)
+    context = "ترند/خبر" if kind == "news" else "موضوع بحثي"
+    return f"""اقترح عنواناً ومخططاً لمقالة عربية رصينة عن {context}: "{topic}"
+- العنوان: جذاب وواضح، أقل من 90 حرفاً.
+- من 4 إلى 6 عناوين فرعية (H2) تغطي مقدمة وأمثلة وخاتمة.
+{avoid}
+أجب بهذه الصيغة فقط دون أي شيء آخر:
+العنوان: ...
+- عنوان فرعي
+- عنوان فرعي
+""".strip()
+
+
+_OUTLINE_PREAMBLE_RE = re.compile(
+    r"(?<!\w)(إليك|إليكم|فيما يلي|عنوان(اً|ا)? ومخطط\w*|بالتأكيد|here is|here's|sure|suggested)(?!\w)",
+    flags=re.I)
+
+
+def parse_outline(text):
+    """
+    يرجع (العنوان، [عناوين H2]) من رد مرحلة المخطط.
+    سطر "العنوان:" الصريح يتقدّم دائماً، ثم سطر H1، ثم أول سطر عادي؛ والأخير
+    وحده يُرفض إذا بدا كمقدمة من الموديل (فنعود للتوليد المباشر).
+    """
+    explicit, h1, guessed, outline = "", "", "", []
+    for line in text.splitlines():
+        t = line.replace("**", "").strip()
+        if not t: continue
+        m = re.match(r"^(?:العنوان|Title)\s*[:：]\s*(.+)$", t, flags=re.I)
+        if m:
+            explicit = explicit or m.group(1)
+        elif re.match(r"^#\s+", t) and not h1:
+            h1 = t  # H1 يتقدّم على أول سطر عادي
+        elif re.match(r"^([-*•]|\d+[.)]|#{2,})\s*", t):
+            outline.append(re.sub(r"^([-*•]|\d+[.)])\s+", "", t))
+        elif not guessed:
+            guessed = t
+    if guessed.endswith((":", "：")) or _OUTLINE_PREAMBLE_RE.search(guessed):
+        guessed = ""
+    title = re.sub(r"^#+\s*", "", explicit or h1
+                   or guessed).strip(" \"'*")[:90]
+    outline = [re.sub(r"^(#+\s*|H2\s*[:\-–]\s*)+", "", h).strip(" *")
+               for h in outline]
+    return title, [h for h in outline if h][:6]
+
+
+def plan_unique_outline(topic, kind, category, used_title_set):
+    """
+    المرحلة الأولى: عنوان + مخطط من موديل صغير، ويُفحص العنوان ضد السجل.
+    يرجع (title, outline) أو None إذا بقي العنوان مكرّراً.
+    """
+    avoid = []
+    for _ in range(OUTLINE_TRIES):
+        text, _, _ = _generate(build_outline_prompt_ar(topic, kind, avoid),
+                               category=category,
+                               max_output_tokens=OUTLINE_MAX_TOKENS,
+                               prefer=OUTLINE_MODEL,
+                               kind="outline")
+        title, outline = parse_outline(strip_code_fences(text))
+        if not title:
+            raise RuntimeError(f"outline without a usable title: {text[:200]}")
+        if title not in used_title_set:
+            print(f"[OUTLINE] approved: {title} ({len(outline)} H2)")
+            return title, outline
+        print(f"[OUTLINE] duplicate title, retrying: {title}")
+        avoid.append(title)
+    return None
+
+
+def enforce_title(article_md, title):
+    """يجعل السطر الأول عنوان H1 المعتمد من مرحلة المخطط."""
+    body = article_md.lstrip()
+    if re.match(r"^#\s+", body):
+        body = body.split("\n", 1)[1] if "\n" in body else ""
+    return f"# {title}\n\n{body.lstrip()}"
+
+
+def plan_or_none(topic, kind, category, used_title_set):
+    """
+    غلاف المرحلة الأولى: يرجع (plan, duplicate).
+    عند فشل المرحلة الأولى نفسها نعود للتوليد المباشر (plan=None, duplicate=False).
+    """
+    if not OUTLINE_PRECHECK:
+        return None, False
+    try:
+        plan = plan_unique_outline(topic, kind, category, used_title_set)
+    except Exception as e:
+        print(f"[OUTLINE] precheck failed, generating directly: {e}")
+        return None, False
+    return plan, plan is None
+
+
 # =================== النشر مع منع التكرار ===================
 def extract_title(article_md, fallback_topic):
     m = re.search(r"^\s*#+\s*(.+)$", article_md, flags=re.M)
@@ -664,25 +1331,37 @@ def regenerate_until_unique(category, slot_idx, max_tries=3):
         picked = choose_topic_for_category(category, slot_idx)
         if isinstance(picked, tuple):
             topic, link = picked
-            prompt = build_prompt_ar(topic, kind="news", news_link=link)
-            search_query = topic
+            kind = "news"
         else:
-            topic = picked
-            prompt = build_prompt_ar(topic, kind="general")
-            search_query = topic
+            topic, link = picked, None
+            kind = "general"
+        search_query = topic
 
         topic_key = norm_topic_key(topic)
         if topic_key in used_topic_keys or topic_key in tried_keys:
             tried_keys.add(topic_key)
             continue
 
-        article_md = ask_gemini(prompt)
-        article_md = ensure_references_clickable(
-            article_md,
-            category,
-            topic,
-            news_link=link if isinstance(picked, tuple) else None)
-        title = extract_title(article_md, topic)
+        # 1) عنوان + مخطط رخيص؛ لا ندفع ثمن مقالة كاملة لعنوان مكرّر
+        plan, duplicate = plan_or_none(topic, kind, category, used_title_set)
+        if duplicate:
+            tried_keys.add(topic_key)
+            continue
+
+        # 2) المقالة الكاملة مقيّدة بالعنوان والمخطط المعتمدين
+        prompt = build_prompt_ar(topic,
+                                 kind=kind,
+                                 news_link=link,
+                                 title=plan[0] if plan else None,
+                                 outline=plan[1] if plan else None)
+        article_md = ask_gemini(prompt, category=category)
+        if plan:
+            article_md = enforce_title(article_md, plan[0])
+        article_md = ensure_references_clickable(article_md,
+                                                 category,
+                                                 topic,
+                                                 news_link=link)
+        title = plan[0] if plan else extract_title(article_md, topic)
 
         last_title, last_article, last_query = title, article_md, search_query
 
@@ -692,16 +1371,27 @@ def regenerate_until_unique(category, slot_idx, max_tries=3):
         tried_keys.add(topic_key)
 
     # fallback مضمون
-    fallback_pool = (TOPICS_TECH + TOPICS_SCIENCE + TOPICS_ECON)
+    fallback_pool = [
+        fb for fb in (TOPICS_TECH + TOPICS_SCIENCE + TOPICS_ECON)
+        if norm_topic_key(fb) not in used_topic_keys
+        and norm_topic_key(fb) not in tried_keys
+    ]
     random.shuffle(fallback_pool)
-    for fb in fallback_pool:
+    for i, fb in enumerate(fallback_pool):
         fb_key = norm_topic_key(fb)
-        if fb_key in used_topic_keys or fb_key in tried_keys:
-            continue
-        prompt = build_prompt_ar(fb, kind="general")
-        article_md = ask_gemini(prompt)
+        plan, duplicate = plan_or_none(fb, "general", category,
+                                       used_title_set)
+        if duplicate and i < len(fallback_pool) - 1:
+            continue  # آخر مرشح يُولَّد دائماً (مع لاحقة تاريخ عند التكرار)
+        prompt = build_prompt_ar(fb,
+                                 kind="general",
+                                 title=plan[0] if plan else None,
+                                 outline=plan[1] if plan else None)
+        article_md = ask_gemini(prompt, category=category)
+        if plan:
+            article_md = enforce_title(article_md, plan[0])
         article_md = ensure_references_clickable(article_md, category, fb)
-        title = extract_title(article_md, fb)
+        title = plan[0] if plan else extract_title(article_md, fb)
         if title in used_title_set:
             suffix = datetime.now(TZ).strftime(" — %Y/%m/%d %H:%M")
             title = f"{title}{suffix}"
@@ -713,29 +1403,190 @@ def regenerate_until_unique(category, slot_idx, max_tries=3):
 
 
 def make_article_once(slot_idx):
-    category = slot_category_for_today(slot_idx, date.today())
+    claim = claim_slot(slot_idx)
+    try:
+        _make_article_run(slot_idx)
+    finally:
+        release_slot(claim)
 
-    # 1) توليد مضمون غير مكرر وضمان "المراجع"
-    title, article_md, search_query, topic_key = regenerate_until_unique(
-        category, slot_idx)
 
-    # 2) تحويل أي روابط عارية إلى روابط قابلة للنقر
-    article_md = linkify_urls_md(article_md)
+def _make_article_run(slot_idx):
+    # كل مرحلة تُحفظ في الـ outbox؛ إعادة المحاولة تستأنف من آخر مرحلة مكتملة
+    run_id, st = open_outbox_run(slot_idx)
+    if st:
+        print(f"[OUTBOX] resuming {run_id} after: {', '.join(st)}")
+
+    # 1) توليد مضمون غير مكرر وضمان "المراجع"
+    if "article" not in st:
+        category = slot_category_for_today(slot_idx, date.today())
+        title, article_md, search_query, topic_key = regenerate_until_unique(
+            category, slot_idx)
+        st["topic"] = checkpoint(
+            run_id, "topic", {
+                "category": category,
+                "search_query": search_query,
+                "topic_key": topic_key
+            })
+
+        # 2) تحويل أي روابط عارية إلى روابط قابلة للنقر
+        article_md = linkify_urls_md(article_md)
+        st["article"] = checkpoint(run_id, "article", {
+            "title": title,
+            "article_md": article_md
+        })
+    category = st["topic"]["category"]
+    title = st["article"]["title"]
 
     # 3) صورة مضمونة في البداية
-    image = fetch_image(search_query)
+    if "image" not in st:
+        st["image"] = checkpoint(run_id, "image",
+                                 fetch_image(st["topic"]["search_query"]))
+    image = st["image"]
     print(f"[IMG] using: {image['url']}")
-    html_content = build_post_html(title, image, article_md)
-
-    # 4) نشر إلى Blogger
-    labels = labels_for_category(category)
-    result = post_to_blogger(title, html_content, labels=labels)
-    record_publish(title, topic_key)
+    if "html" not in st:
+        st["html"] = checkpoint(
+            run_id, "html",
+            {"html": build_post_html(title, image, st["article"]["article_md"])})
+
+    # 4) نشر إلى Blogger — مرة واحدة فقط لكل تشغيل
+    if "post" not in st:
+        existing = None
+        if "publishing" in st:
+            # انقطعنا بعد بدء الإدراج: ربما نُشرت التدوينة فعلاً
+            existing = find_post_by_title(title)
+        if existing is None:
+            checkpoint(run_id, "publishing", {})
+            labels = labels_for_category(category)
+            existing = post_to_blogger(title,
+                                       st["html"]["html"],
+                                       labels=labels)
+        st["post"] = checkpoint(run_id, "post", {
+            "id": existing.get("id"),
+            "url": existing.get("url", "")
+        })
+    result = st["post"]
+    record_publish(title, st["topic"]["topic_key"])
+    finish_outbox_run(run_id)
 
     state = "مسودة" if (PUBLISH_MODE != "live") else "منشور حي"
     print(
-        f"[{datetime.now(TZ)}] {state}: {result.get('url', 'بدون رابط')} | {category} | {title}"
+        f"[{datetime.now(TZ)}] {state}: {result.get('url') or 'بدون رابط'} | {category} | {title}"
     )
+    print(token_usage_report())
+
+
+# =================== وضع القياس (Profiling) ===================
+_profile_lock = threading.Lock()  # مُحلّل واحد فقط في كل لحظة
+_profile_prev = {"snapshot": None, "rss_kb": None}
+
+
+def current_rss_kb():
+    """الذاكرة المقيمة الحالية (KB) من /proc؛ None حيث لا يتوفر /proc."""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_kb():
+    """ذروة RSS منذ بدء العملية (KB) — لا تصلح لحساب فروق بين التشغيلات."""
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # macOS بالبايت
+
+
+def _alloc_lines(stats):
+    return "\n".join(f"  {st}" for st in stats[:PROFILE_TOP_N]) or "  -"
+
+
+def write_profile_report(slot_idx, prof, rss_before, error=None):
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    rss_after = current_rss_kb()
+    prev_rss = _profile_prev["rss_kb"]
+    traced, peak = tracemalloc.get_traced_memory()
+
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(
+        PROFILE_TOP_N)
+    growth = (snapshot.compare_to(_profile_prev["snapshot"], "lineno")
+              if _profile_prev["snapshot"] else [])
+
+    now = datetime.now(TZ)
+    summary = {
+        "time": now.isoformat(),
+        "slot": slot_idx,
+        "ok": error is None,
+        "rss_before_kb": rss_before,
+        "rss_after_kb": rss_after,
+        # الفروق تُحسب من RSS الحالي فقط؛ بدون /proc لا نملك قيمة صحيحة
+        "rss_delta_run_kb": (rss_after - rss_before)
+        if rss_after is not None and rss_before is not None else None,
+        "rss_delta_prev_kb": (rss_after - prev_rss)
+        if rss_after is not None and prev_rss is not None else None,
+        "rss_peak_kb": peak_rss_kb(),
+        "traced_kb": traced // 1024,
+        "traced_peak_kb": peak // 1024
+    }
+    if rss_after is None:
+        rss_line = f"rss: current unavailable (no /proc) peak={summary['rss_peak_kb']}KB — deltas not computed"
+    else:
+        rss_line = f"rss: before={rss_before}KB after={rss_after}KB run_delta={summary['rss_delta_run_kb']}KB since_prev_run={summary['rss_delta_prev_kb']}KB peak={summary['rss_peak_kb']}KB"
+    report = "\n".join([
+        f"run: {now.isoformat()} slot={slot_idx} status={'ok' if error is None else f'error: {error}'}",
+        rss_line,
+        f"tracemalloc: current={summary['traced_kb']}KB peak={summary['traced_peak_kb']}KB",
+        "", "=== Top cumulative functions ===",
+        out.getvalue().strip(), "", "=== Top allocation sites ===",
+        _alloc_lines(snapshot.statistics("lineno")), "",
+        "=== Growth since previous run ===",
+        _alloc_lines(growth) if growth else "  (first profiled run)", ""
+    ])
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR,
+                        now.strftime(f"run-%Y%m%d-%H%M%S-slot{slot_idx}.txt"))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(report)
+    append_jsonl(os.path.join(PROFILE_DIR, "runs.jsonl"), summary)
+    _profile_prev.update(snapshot=snapshot, rss_kb=rss_after)
+    print(
+        f"[PROFILE] {path} | rss={rss_after}KB Δprev={summary['rss_delta_prev_kb']}KB peak={summary['rss_peak_kb']}KB"
+    )
+
+
+def profiled_make_article(slot_idx):
+    with _profile_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)  # يبقى فعّالاً لمقارنة اللقطات بين التشغيلات
+        rss_before = current_rss_kb()
+        prof = cProfile.Profile()
+        error = None
+        try:
+            prof.enable()
+            make_article_once(slot_idx)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            prof.disable()
+            try:
+                write_profile_report(slot_idx, prof, rss_before, error)
+            except Exception as e:
+                print(f"[PROFILE] report error: {e}")
+
+
+def run_article_job(slot_idx):
+    """نقطة الدخول لكل تشغيل (جدولة/Webhook/تشغيل مرة واحدة)."""
+    if PROFILE_MODE:
+        return profiled_make_article(slot_idx)
+    return make_article_once(slot_idx)
 
 
 # =================== Webhook (لو استخدمنا كرون خارجي) ===================
@@ -754,8 +1605,10 @@ def trigger():
         i = int(slot)
         if i not in (0, 1):
             return jsonify({"ok": False, "error": "slot must be 0 or 1"}), 400
-        make_article_once(i)
+        run_article_job(i)
         return jsonify({"ok": True, "slot": i}), 200
+    except SlotBusyError as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
@@ -765,7 +1618,7 @@ def schedule_jobs():
     sched = BackgroundScheduler(timezone=TZ)
     for idx, t in enumerate(POST_TIMES_LOCAL):
         hour, minute = map(int, t.split(":"))
-        sched.add_job(lambda i=idx: make_article_once(i),
+        sched.add_job(lambda i=idx: run_article_job(i),
                       "cron",
                       hour=hour,
                       minute=minute,
@@ -804,8 +1657,8 @@ if __name__ == "__main__":
     else:
         # الوضع العادي: بروفة أو جدولة داخلية
         if RUN_ONCE:
-            make_article_once(0)  # الصباحية
-            make_article_once(1)  # المسائية
+            run_article_job(0)  # الصباحية
+            run_article_job(1)  # المسائية
         else:
             schedule_jobs()
             try:
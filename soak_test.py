@@ -0,0 +1,279 @@
+"""
+اختبار تحمّل (Soak): يشغّل make_article_once مرات كثيرة ضد بدائل وهمية
+للشبكة (Gemini/RSS/ويكيبيديا/Blogger) ويراقب نمو الذاكرة المقيمة RSS.
+
+    python soak_test.py --runs 300
+    PROFILE_MODE=1 python soak_test.py --runs 50   # مع تقارير cProfile/tracemalloc
+
+يرجع رمز خروج 1 إذا تجاوز نمو RSS (بعد الإحماء) الحد المسموح،
+و2 حيث لا يتوفر /proc (لا يمكن قياس RSS الحالي).
+"""
+import os, sys, io, gc, json, argparse, tempfile, itertools
+
+for _k in ("GEMINI_API_KEY", "BLOG_URL", "CLIENT_ID", "CLIENT_SECRET",
+           "REFRESH_TOKEN"):
+    os.environ.setdefault(_k, "soak")
+os.environ["BLOG_URL"] = "https://soak.blogspot.com/"
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+_counter = itertools.count(1)
+
+
+# =================== بدائل الشبكة ===================
+class FakeResponse:
+
+    def __init__(self, status_code=200, payload=None, body=b""):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload) if payload is not None else ""
+        self.raw = io.BytesIO(body)
+        self.raw.decode_content = False
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise main.requests.HTTPError(f"{self.status_code}")
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fake_rss(n=40):
+    items = "".join(f"<item><title>ترند رقم {i} {next(_counter)}</title>"
+                    f"<link>https://news.example.org/{i}</link></item>"
+                    for i in range(n))
+    return f'<?xml version="1.0" encoding="UTF-8"?><rss><channel><title>x</title>{items}</channel></rss>'.encode(
+    )
+
+
+def fake_article():
+    n = next(_counter)
+    para = " ".join(["نص تجريبي للمقالة"] * 60) + "."
+    sections = "\n\n".join(f"## قسم {i}\n\n{para}" for i in range(6))
+    return (f"# عنوان تجريبي رقم {n}\n\n{sections}\n\n## المراجع\n"
+            f"- [مرجع](https://ref.example.org/{n})\n"
+            f"- [مرجع مكسور](https://dead.example.org/{n})\n")
+
+
+def fake_outline():
+    n = next(_counter)
+    h2 = "\n".join(f"- قسم {i}" for i in range(5))
+    return f"العنوان: عنوان تجريبي رقم {n}\n{h2}"
+
+
+def fake_get(url, params=None, **kw):
+    if "generativelanguage" in url:
+        return FakeResponse(
+            payload={
+                "models": [{
+                    "name": main.MODEL_CANDIDATES[0],
+                    "supportedGenerationMethods": ["generateContent"]
+                }]
+            })
+    if "wikipedia.org" in url:
+        src = "https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/X.jpg/1280px-X.jpg"
+        return FakeResponse(
+            payload={
+                "query": {
+                    "pages": {
+                        "1": {
+                            "original": {
+                                "source": src,
+                                "width": 3000,
+                                "height": 2000
+                            },
+                            "thumbnail": {
+                                "source": src,
+                                "width": 1280,
+                                "height": 853
+                            }
+                        }
+                    }
+                }
+            })
+    if "rss" in url:
+        return FakeResponse(body=fake_rss())
+    return FakeResponse(status_code=404 if "dead." in url else 200)
+
+
+def fake_head(url, **kw):
+    return FakeResponse(status_code=404 if "dead." in url else 200)
+
+
+def fake_post(url, json=None, **kw):
+    prompt = json["contents"][-1]["parts"][0]["text"]
+    text = fake_outline() if "ومخططاً" in prompt else fake_article()
+    return FakeResponse(
+        payload={
+            "candidates": [{
+                "content": {
+                    "parts": [{
+                        "text": text
+                    }]
+                },
+                "finishReason": "STOP"
+            }],
+            "usageMetadata": {
+                "promptTokenCount": 300,
+                "candidatesTokenCount": len(text.split()) * 2
+            }
+        })
+
+
+class _Call:
+
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeBlogger:
+
+    def blogs(self):
+        return self
+
+    def posts(self):
+        return self
+
+    def getByUrl(self, url):
+        return _Call({"id": "1"})
+
+    # قيم enum كما في وثيقة Blogger v3 (googleapiclient يرفض غيرها قبل الإرسال)
+    _LIST_ENUMS = {
+        "orderBy": {"PUBLISHED", "UPDATED"},
+        "status": {"LIVE", "DRAFT", "SCHEDULED", "SOFT_TRASHED"},
+        "view": {"READER", "AUTHOR", "ADMIN"},
+    }
+
+    def list(self,
+             blogId,
+             fetchBodies=None,
+             maxResults=None,
+             orderBy=None,
+             status=None,
+             view=None):
+        args = {"orderBy": orderBy, "status": status, "view": view}
+        for name, value in args.items():
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not None and v not in self._LIST_ENUMS[name]:
+                    raise TypeError(
+                        f'Parameter "{name}" value "{v}" is not an allowed value'
+                    )
+        return _Call({"items": []})
+
+    def insert(self, blogId, body, isDraft=True):
+        n = next(_counter)
+        return _Call({"id": str(n), "url": f"https://soak.blogspot.com/{n}"})
+
+
+def install_stubs():
+    main.requests.get = fake_get
+    main.requests.post = fake_post
+    main.requests.head = fake_head
+    main.build = lambda *a, **kw: FakeBlogger()
+
+
+# =================== فحوص انحدار سريعة ===================
+def self_checks():
+    """حالات حقيقية سبق أن أفسدت المقالة؛ تُشغَّل قبل حلقة التحمّل."""
+    install_stubs()
+    with tempfile.TemporaryDirectory(prefix="soak-check-") as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            # رابط ماركداون نصه هو الرابط نفسه: لا يُعامل كرابط عارٍ مشوَّه
+            md = ("نص [https://dead.example.org/a](https://dead.example.org/a)"
+                  " و [https://ok.example.org/b](https://ok.example.org/b)\n")
+            out = main.replace_broken_links(md)
+            assert "[)" not in out and "dead.example.org" not in out, out
+            assert "[https://ok.example.org/b](https://ok.example.org/b)" in out, out
+            assert main.link_urls(md) == [
+                "https://dead.example.org/a", "https://ok.example.org/b"
+            ]
+            assert "[[" not in main.linkify_urls_md(md)
+            # مرحلة المخطط: لا تصبح مقدمة الموديل عنواناً، ولا تُرفض عناوين حقيقية
+            assert main.parse_outline(
+                "إليك عنواناً ومخططاً مقترحاً:\nالعنوان: X\n- أ")[0] == "X"
+            assert main.parse_outline(
+                "العنوان: مقترح قانون الموازنة\n- أ")[0] == "مقترح قانون الموازنة"
+            assert main.parse_outline(
+                "Title: Pressure on markets\n## a") == ("Pressure on markets",
+                                                        ["a"])
+            assert main.parse_outline("إليك مخططاً:\n- أ")[0] == ""
+            # مسار الاستئناف بعد الانقطاع: قيم enum صحيحة لـ posts().list
+            assert main.find_post_by_title("عنوان غير موجود") is None
+        finally:
+            os.chdir(cwd)
+    print("[SOAK] self-checks OK")
+
+
+# =================== التشغيل والقياس ===================
+def slope_kb_per_run(samples):
+    """ميل الانحدار الخطي (KB لكل تشغيل)."""
+    n = len(samples)
+    if n < 2: return 0.0
+    mx = (n - 1) / 2
+    my = sum(samples) / n
+    num = sum((i - mx) * (y - my) for i, y in enumerate(samples))
+    den = sum((i - mx)**2 for i in range(n))
+    return num / den
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="Soak test for make_article_once")
+    ap.add_argument("--runs", type=int, default=200)
+    ap.add_argument("--warmup", type=int, default=10)
+    ap.add_argument("--max-growth-mb",
+                    type=float,
+                    default=16.0,
+                    help="أقصى نمو مسموح لـ RSS (مقدّر بالميل) عبر كل التشغيلات")
+    args = ap.parse_args()
+
+    if main.current_rss_kb() is None:
+        print("[SOAK] current RSS needs /proc (Linux); peak RSS cannot show growth")
+        return 2
+
+    self_checks()
+    cwd = os.getcwd()
+    samples = []
+    # سجلات jsonl في مجلد مؤقت يُحذف بعد الانتهاء
+    with tempfile.TemporaryDirectory(prefix="soak-") as workdir:
+        os.chdir(workdir)
+        try:
+            print(f"[SOAK] workdir={workdir} runs={args.runs}")
+            for i in range(args.runs):
+                main.run_article_job(i % 2)
+                gc.collect()
+                rss = main.current_rss_kb()
+                if i >= args.warmup:
+                    samples.append(rss)
+                if i % 10 == 0 or i == args.runs - 1:
+                    print(f"[SOAK] run {i + 1}/{args.runs} rss={rss}KB")
+        finally:
+            os.chdir(cwd)
+
+    slope = slope_kb_per_run(samples)
+    projected_mb = slope * len(samples) / 1024
+    print(f"[SOAK] rss slope={slope:.1f}KB/run "
+          f"projected growth={projected_mb:.1f}MB over {len(samples)} runs")
+    if projected_mb > args.max_growth_mb:
+        print("[SOAK] FAIL: resident memory keeps growing")
+        return 1
+    print("[SOAK] OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())